@@ -18,10 +18,14 @@ from __future__ import print_function
 
 import cv2
 import time
+import ctypes
+import ctypes.util
 import yaml
 import os, sys
+import queue
+import threading
+import weakref
 import numpy as np
-from functools import reduce
 import paddle.fluid as fluid
 
 # add utils path of PadleDetection to sys.path
@@ -29,7 +33,8 @@ parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 3)))
 if parent_path not in sys.path:
     sys.path.append(parent_path)
 
-from utils.preprocess import preprocess, Resize, Normalize, Permute, PadStride
+from utils.preprocess import (preprocess, decode_image, fuse_preprocess_ops,
+                              Resize, Normalize, Permute, PadStride)
 from utils.visualize import visualize_box_mask, lmk2out
 
 # Global dictionary
@@ -45,6 +50,54 @@ SUPPORT_MODELS = {
     'SOLOv2',
 }
 
+# SUPPORT_MODELS in the precedence of matching an arch, same as the order
+# inputs are decided in create_inputs
+MODEL_TYPE_ORDER = (
+    'YOLO',
+    'RetinaNet',
+    'EfficientDet',
+    'RCNN',
+    'FCOS',
+    'TTF',
+    'SOLOv2',
+    'SSD',
+    'Face',
+)
+
+# tag of model type, decides the inputs besides image
+ARCH_OTHER = -1
+ARCH_YOLO = 0
+ARCH_RETINA_OR_EFFDET = 1
+ARCH_RCNN_OR_FCOS = 2
+ARCH_TTF = 3
+ARCH_SOLO = 4
+
+ARCH_TAGS = {
+    'YOLO': ARCH_YOLO,
+    'RetinaNet': ARCH_RETINA_OR_EFFDET,
+    'EfficientDet': ARCH_RETINA_OR_EFFDET,
+    'RCNN': ARCH_RCNN_OR_FCOS,
+    'FCOS': ARCH_RCNN_OR_FCOS,
+    'TTF': ARCH_TTF,
+    'SOLOv2': ARCH_SOLO,
+}
+
+# [1, size] inputs besides image of each model type: (name, size, dtype)
+INFO_INPUTS = {
+    ARCH_YOLO: [('im_size', 2, 'int32')],
+    ARCH_RETINA_OR_EFFDET: [('im_info', 3, 'float32')],
+    ARCH_RCNN_OR_FCOS: [('im_info', 3, 'float32'),
+                        ('im_shape', 3, 'float32')],
+    ARCH_SOLO: [('im_info', 3, 'float32')],
+}
+
+PREPROCESS_OPS = {
+    'Resize': Resize,
+    'Normalize': Normalize,
+    'Permute': Permute,
+    'PadStride': PadStride,
+}
+
 
 class Detector(object):
     """
@@ -52,8 +105,11 @@ class Detector(object):
         config (object): config of model, defined by `Config(model_dir)`
         model_dir (str): root path of __model__, __params__ and infer_cfg.yml
         use_gpu (bool): whether use gpu
-        run_mode (str): mode of running(fluid/trt_fp32/trt_fp16)
+        run_mode (str): mode of running(fluid/trt_fp32/trt_fp16/trt_int8/
+                        mkldnn_bf16/mkldnn_int8), mkldnn_bf16 needs
+                        PaddlePaddle >= 2.0, mkldnn_int8 needs >= 2.3
         threshold (float): threshold to reserve the result for output.
+        batch_size (int): max number of images fed by `predict_batch`
     """
 
     def __init__(self,
@@ -61,65 +117,145 @@ class Detector(object):
                  model_dir,
                  use_gpu=False,
                  run_mode='fluid',
-                 threshold=0.5):
+                 threshold=0.5,
+                 batch_size=1):
         self.config = config
+        # SSD/Face output boxes normalized to [0, 1], decided once by arch
+        # instead of on every postprocess
+        self.normalized_boxes = self.config.arch in ['SSD', 'Face']
         if self.config.use_python_inference:
             self.executor, self.program, self.fecth_targets = load_executor(
                 model_dir, use_gpu=use_gpu)
+            # LoDTensor can share memory with numpy array only on CPU
+            self._zero_copy_feed = not use_gpu
         else:
             self.predictor = load_predictor(
                 model_dir,
                 run_mode=run_mode,
+                batch_size=batch_size,
                 min_subgraph_size=self.config.min_subgraph_size,
                 use_gpu=use_gpu)
-
-    def preprocess(self, im):
-        preprocess_ops = []
-        for op_info in self.config.preprocess_infos:
-            new_op_info = op_info.copy()
-            op_type = new_op_info.pop('type')
-            if op_type == 'Resize':
-                new_op_info['arch'] = self.config.arch
-            preprocess_ops.append(eval(op_type)(**new_op_info))
-        im, im_info = preprocess(im, preprocess_ops)
-        inputs = create_inputs(im, im_info, self.config.arch)
+            # handles of input/output tensors are fixed once predictor created
+            self._input_names = self.predictor.get_input_names()
+            self._input_tensors = [
+                self.predictor.get_input_tensor(name)
+                for name in self._input_names
+            ]
+            self._output_names = self.predictor.get_output_names()
+            self._output_tensors = [
+                self.predictor.get_output_tensor(name)
+                for name in self._output_names
+            ]
+        # reuse one image buffer across calls when the input shape is fixed
+        self._image_buf = None
+        im_shape = get_input_shape(self.config.preprocess_infos)
+        if im_shape is not None:
+            self._image_buf = np.empty(
+                (batch_size, ) + im_shape, dtype=np.float32)
+            # copy_from_cpu can DMA from pinned memory without staging
+            if use_gpu and not pin_memory(self._image_buf):
+                print('[WARNNING] Failed to pin input buffer, '
+                      'fall back to pageable memory.')
+        # reuse the small info inputs (im_size, im_info...) the same way
+        self._info_bufs = {
+            name: np.empty((batch_size, size), dtype=dtype)
+            for name, size, dtype in INFO_INPUTS.get(self.config.arch_tag, [])
+        }
+
+    def preprocess(self, im, batch_index=0):
+        '''
+        Args:
+            im (str/np.ndarray): path of image/ np.ndarray read by cv2
+            batch_index (int): slot of the reusable buffers to write into
+        Returns:
+            inputs (dict): input of model, inputs['image'] (when the input
+                           shape is fixed) and im_size/im_info/im_shape alias
+                           slot batch_index of the Detector's reusable
+                           buffers, they are only valid until the next
+                           preprocess call for the same slot
+            im_info (dict): info of processed image
+        '''
+        im_buf = None
+        if self._image_buf is not None and batch_index < len(self._image_buf):
+            im_buf = self._image_buf[batch_index:batch_index + 1]
+        im, im_info = preprocess(
+            im, self.config.preprocess_ops, im_buf=im_buf)
+        info_bufs = {
+            name: buf[batch_index:batch_index + 1]
+            for name, buf in self._info_bufs.items()
+            if batch_index < len(buf)
+        }
+        inputs = create_inputs(
+            im, im_info, self.config.arch_tag, info_bufs=info_bufs)
         return inputs, im_info
 
+    def create_feed(self, inputs):
+        # wrap inputs as LoDTensor sharing memory with the numpy arrays, the
+        # executor then feeds them without copying the image again
+        if not self._zero_copy_feed:
+            return inputs
+        # the tensor holds a reference to the array it wraps, so the array
+        # stays alive as long as the tensor is fed
+        feed = {}
+        for name, arr in inputs.items():
+            tensor = fluid.core.LoDTensor()
+            tensor.set(arr, fluid.CPUPlace(), zero_copy=True)
+            feed[name] = tensor
+        return feed
+
     def postprocess(self, np_boxes, np_masks, np_lmk, im_info, threshold=0.5):
         # postprocess output of predictor
         results = {}
         if np_lmk is not None:
             results['landmark'] = lmk2out(np_boxes, np_lmk, im_info, threshold)
 
-        if self.config.arch in ['SSD', 'Face']:
+        if self.normalized_boxes:
             w, h = im_info['origin_shape']
-            np_boxes[:, 2] *= h
-            np_boxes[:, 3] *= w
-            np_boxes[:, 4] *= h
-            np_boxes[:, 5] *= w
+            # scale x_min, y_min, x_max, y_max in one pass
+            scale = np.array([h, w, h, w], dtype=np_boxes.dtype)
+            np_boxes[:, 2:6] *= scale
         expect_boxes = (np_boxes[:, 1] > threshold) & (np_boxes[:, 0] > -1)
-        np_boxes = np_boxes[expect_boxes, :]
-        for box in np_boxes:
-            print('class_id:{:d}, confidence:{:.4f},'
-                  'left_top:[{:.2f},{:.2f}],'
-                  ' right_bottom:[{:.2f},{:.2f}]'.format(
-                      int(box[0]), box[1], box[2], box[3], box[4], box[5]))
+        np_boxes = np.compress(expect_boxes, np_boxes, axis=0)
+        if len(np_boxes) > 0:
+            # format all boxes at once and write them in a single call
+            box_fmt = ('class_id:%d, confidence:%.4f,'
+                       'left_top:[%.2f,%.2f],'
+                       ' right_bottom:[%.2f,%.2f]')
+            sys.stdout.write('\n'.join(
+                box_fmt % tuple(box[:6]) for box in np_boxes.tolist()) + '\n')
         results['boxes'] = np_boxes
         if np_masks is not None:
-            np_masks = np_masks[expect_boxes, :, :, :]
+            np_masks = np.compress(expect_boxes, np_masks, axis=0)
             results['masks'] = np_masks
         return results
 
+    def copy_outputs(self):
+        # copy outputs of the last zero_copy_run from predictor to host
+        np_boxes = self._output_tensors[0].copy_to_cpu()
+        np_masks, np_lmk = None, None
+        if self.config.mask_resolution is not None:
+            np_masks = self._output_tensors[1].copy_to_cpu()
+        if self.config.with_lmk is not None and self.config.with_lmk == True:
+            face_index, landmark, prior_boxes = self._output_tensors[1:4]
+            np_lmk = [
+                face_index.copy_to_cpu(), landmark.copy_to_cpu(),
+                prior_boxes.copy_to_cpu()
+            ]
+        return np_boxes, np_masks, np_lmk
+
     def predict(self,
                 image,
                 threshold=0.5,
                 warmup=0,
                 repeats=1,
-                run_benchmark=False):
+                run_benchmark=False,
+                copy_every_repeat=False):
         '''
         Args:
             image (str/np.ndarray): path of image/ np.ndarray read by cv2
             threshold (float): threshold of predicted box' score
+            copy_every_repeat (bool): copy outputs to host after every repeat,
+                                      so the timing includes the transfer
         Returns:
             results (dict): include 'boxes': np.ndarray: shape:[N,6], N: number of box,
                             matix element:[class, score, x_min, y_min, x_max, y_max]
@@ -129,79 +265,49 @@ class Detector(object):
         inputs, im_info = self.preprocess(image)
         np_boxes, np_masks, np_lmk = None, None, None
         if self.config.use_python_inference:
+            feed = self.create_feed(inputs)
             for i in range(warmup):
                 outs = self.executor.run(self.program,
-                                         feed=inputs,
+                                         feed=feed,
                                          fetch_list=self.fecth_targets,
                                          return_numpy=False)
             t1 = time.time()
             for i in range(repeats):
                 outs = self.executor.run(self.program,
-                                         feed=inputs,
+                                         feed=feed,
                                          fetch_list=self.fecth_targets,
                                          return_numpy=False)
             t2 = time.time()
             ms = (t2 - t1) * 1000.0 / repeats
             print("Inference: {} ms per batch image".format(ms))
-            np_boxes = np.array(outs[0])
+            # LoDTensor exposes its buffer, asarray makes a view, not a copy
+            np_boxes = np.asarray(outs[0])
             if self.config.mask_resolution is not None:
-                np_masks = np.array(outs[1])
+                np_masks = np.asarray(outs[1])
         else:
-            input_names = self.predictor.get_input_names()
-            for i in range(len(input_names)):
-                input_tensor = self.predictor.get_input_tensor(input_names[i])
-                input_tensor.copy_from_cpu(inputs[input_names[i]])
+            for input_tensor, name in zip(self._input_tensors,
+                                          self._input_names):
+                input_tensor.copy_from_cpu(inputs[name])
 
+            # warmup only primes kernels, outputs are not needed on host
             for i in range(warmup):
                 self.predictor.zero_copy_run()
-                output_names = self.predictor.get_output_names()
-                boxes_tensor = self.predictor.get_output_tensor(output_names[0])
-                np_boxes = boxes_tensor.copy_to_cpu()
-                if self.config.mask_resolution is not None:
-                    masks_tensor = self.predictor.get_output_tensor(
-                        output_names[1])
-                    np_masks = masks_tensor.copy_to_cpu()
-
-                if self.config.with_lmk is not None and self.config.with_lmk == True:
-                    face_index = self.predictor.get_output_tensor(output_names[
-                        1])
-                    landmark = self.predictor.get_output_tensor(output_names[2])
-                    prior_boxes = self.predictor.get_output_tensor(output_names[
-                        3])
-                    np_face_index = face_index.copy_to_cpu()
-                    np_prior_boxes = prior_boxes.copy_to_cpu()
-                    np_landmark = landmark.copy_to_cpu()
-                    np_lmk = [np_face_index, np_landmark, np_prior_boxes]
 
             t1 = time.time()
             for i in range(repeats):
                 self.predictor.zero_copy_run()
-                output_names = self.predictor.get_output_names()
-                boxes_tensor = self.predictor.get_output_tensor(output_names[0])
-                np_boxes = boxes_tensor.copy_to_cpu()
-                if self.config.mask_resolution is not None:
-                    masks_tensor = self.predictor.get_output_tensor(
-                        output_names[1])
-                    np_masks = masks_tensor.copy_to_cpu()
-
-                if self.config.with_lmk is not None and self.config.with_lmk == True:
-                    face_index = self.predictor.get_output_tensor(output_names[
-                        1])
-                    landmark = self.predictor.get_output_tensor(output_names[2])
-                    prior_boxes = self.predictor.get_output_tensor(output_names[
-                        3])
-                    np_face_index = face_index.copy_to_cpu()
-                    np_prior_boxes = prior_boxes.copy_to_cpu()
-                    np_landmark = landmark.copy_to_cpu()
-                    np_lmk = [np_face_index, np_landmark, np_prior_boxes]
+                if copy_every_repeat:
+                    np_boxes, np_masks, np_lmk = self.copy_outputs()
             t2 = time.time()
             ms = (t2 - t1) * 1000.0 / repeats
             print("Inference: {} ms per batch image".format(ms))
+            if not copy_every_repeat:
+                np_boxes, np_masks, np_lmk = self.copy_outputs()
 
         # do not perform postprocess in benchmark mode
         results = []
         if not run_benchmark:
-            if reduce(lambda x, y: x * y, np_boxes.shape) < 6:
+            if np_boxes.size < 6:
                 print('[WARNNING] No object detected.')
                 results = {'boxes': np.array([])}
             else:
@@ -210,6 +316,90 @@ class Detector(object):
 
         return results
 
+    def predict_batch(self, images, threshold=0.5):
+        '''
+        Args:
+            images (list): paths of image/ np.ndarray read by cv2
+            threshold (float): threshold of predicted box' score
+        Returns:
+            results (list): one dict per image, same format as `predict`
+        '''
+        if not images:
+            return []
+        # landmark outputs can not be split per image
+        if self.config.with_lmk:
+            return [self.predict(image, threshold) for image in images]
+        batch_inputs, im_infos = [], []
+        for i, image in enumerate(images):
+            inputs, im_info = self.preprocess(image, batch_index=i)
+            batch_inputs.append(inputs)
+            im_infos.append(im_info)
+        # images of different shape (e.g. RCNN keeps aspect ratio) can not be
+        # stacked into one feed
+        im_shapes = set(inputs['image'].shape for inputs in batch_inputs)
+        if len(im_shapes) > 1:
+            return [self.predict(image, threshold) for image in images]
+
+        batch_size = len(images)
+        inputs = {}
+        for name in batch_inputs[0].keys():
+            buf = self._image_buf if name == 'image' else self._info_bufs.get(
+                name)
+            if buf is not None and all(im_inputs[name].base is buf
+                                       for im_inputs in batch_inputs):
+                # every image already wrote its input to its slot of buffer
+                inputs[name] = buf[:batch_size]
+                continue
+            arrs = [im_inputs[name] for im_inputs in batch_inputs]
+            # 1-D inputs (TTF scale_factor) gain the batch axis, others
+            # already carry a batch axis of 1
+            if arrs[0].ndim == 1:
+                inputs[name] = np.stack(arrs, axis=0)
+            else:
+                inputs[name] = np.concatenate(arrs, axis=0)
+
+        np_masks, masks_lod = None, None
+        t1 = time.time()
+        if self.config.use_python_inference:
+            outs = self.executor.run(self.program,
+                                     feed=self.create_feed(inputs),
+                                     fetch_list=self.fecth_targets,
+                                     return_numpy=False)
+            np_boxes, boxes_lod = np.asarray(outs[0]), outs[0].lod()
+            if self.config.mask_resolution is not None:
+                np_masks, masks_lod = np.asarray(outs[1]), outs[1].lod()
+        else:
+            for input_tensor, name in zip(self._input_tensors,
+                                          self._input_names):
+                input_tensor.copy_from_cpu(inputs[name])
+            self.predictor.zero_copy_run()
+            boxes_tensor = self._output_tensors[0]
+            np_boxes, boxes_lod = boxes_tensor.copy_to_cpu(), boxes_tensor.lod()
+            if self.config.mask_resolution is not None:
+                masks_tensor = self._output_tensors[1]
+                np_masks = masks_tensor.copy_to_cpu()
+                masks_lod = masks_tensor.lod()
+        t2 = time.time()
+        ms = (t2 - t1) * 1000.0 / batch_size
+        print("Inference: {} ms per batch image".format(ms))
+
+        boxes_list = split_by_lod(np_boxes, boxes_lod, batch_size)
+        masks_list = split_by_lod(np_masks, masks_lod, batch_size)
+        results = []
+        for i in range(batch_size):
+            if boxes_list[i].size < 6:
+                print('[WARNNING] No object detected.')
+                results.append({'boxes': np.array([])})
+            else:
+                results.append(
+                    self.postprocess(
+                        boxes_list[i],
+                        masks_list[i],
+                        None,
+                        im_infos[i],
+                        threshold=threshold))
+        return results
+
 
 class DetectorSOLOv2(Detector):
     def __init__(self,
@@ -217,67 +407,65 @@ class DetectorSOLOv2(Detector):
                  model_dir,
                  use_gpu=False,
                  run_mode='fluid',
-                 threshold=0.5):
+                 threshold=0.5,
+                 batch_size=1):
         super(DetectorSOLOv2, self).__init__(
             config=config,
             model_dir=model_dir,
             use_gpu=use_gpu,
             run_mode=run_mode,
-            threshold=threshold)
+            threshold=threshold,
+            batch_size=batch_size)
+
+    def copy_outputs(self):
+        np_label, np_score, np_segms = [
+            tensor.copy_to_cpu() for tensor in self._output_tensors[:3]
+        ]
+        return np_label, np_score, np_segms
 
     def predict(self,
                 image,
                 threshold=0.5,
                 warmup=0,
                 repeats=1,
-                run_benchmark=False):
+                run_benchmark=False,
+                copy_every_repeat=False):
         inputs, im_info = self.preprocess(image)
         np_label, np_score, np_segms = None, None, None
         if self.config.use_python_inference:
+            feed = self.create_feed(inputs)
             for i in range(warmup):
                 outs = self.executor.run(self.program,
-                                         feed=inputs,
+                                         feed=feed,
                                          fetch_list=self.fecth_targets,
                                          return_numpy=False)
             t1 = time.time()
             for i in range(repeats):
                 outs = self.executor.run(self.program,
-                                         feed=inputs,
+                                         feed=feed,
                                          fetch_list=self.fecth_targets,
                                          return_numpy=False)
             t2 = time.time()
             ms = (t2 - t1) * 1000.0 / repeats
             print("Inference: {} ms per batch image".format(ms))
-            np_label, np_score, np_segms = np.array(outs[0]), np.array(outs[
-                1]), np.array(outs[2])
+            np_label, np_score, np_segms = [np.asarray(out) for out in outs[:3]]
         else:
-            input_names = self.predictor.get_input_names()
-            for i in range(len(input_names)):
-                input_tensor = self.predictor.get_input_tensor(input_names[i])
-                input_tensor.copy_from_cpu(inputs[input_names[i]])
+            for input_tensor, name in zip(self._input_tensors,
+                                          self._input_names):
+                input_tensor.copy_from_cpu(inputs[name])
             for i in range(warmup):
                 self.predictor.zero_copy_run()
-                output_names = self.predictor.get_output_names()
-                np_label = self.predictor.get_output_tensor(output_names[
-                    0]).copy_to_cpu()
-                np_score = self.predictor.get_output_tensor(output_names[
-                    1]).copy_to_cpu()
-                np_segms = self.predictor.get_output_tensor(output_names[
-                    2]).copy_to_cpu()
 
             t1 = time.time()
             for i in range(repeats):
                 self.predictor.zero_copy_run()
-                output_names = self.predictor.get_output_names()
-                np_label = self.predictor.get_output_tensor(output_names[
-                    0]).copy_to_cpu()
-                np_score = self.predictor.get_output_tensor(output_names[
-                    1]).copy_to_cpu()
-                np_segms = self.predictor.get_output_tensor(output_names[
-                    2]).copy_to_cpu()
+                if copy_every_repeat:
+                    np_label, np_score, np_segms = self.copy_outputs()
             t2 = time.time()
             ms = (t2 - t1) * 1000.0 / repeats
             print("Inference: {} ms per batch image".format(ms))
+            if not copy_every_repeat:
+                np_label, np_score, np_segms = self.copy_outputs()
 
         # do not perform postprocess in benchmark mode
         results = []
@@ -285,13 +473,102 @@ class DetectorSOLOv2(Detector):
             return dict(segm=np_segms, label=np_label, score=np_score)
         return results
 
+    def predict_batch(self, images, threshold=0.5):
+        # SOLOv2 outputs carry no lod to split a batch, predict one by one
+        return [self.predict(image, threshold) for image in images]
 
-def create_inputs(im, im_info, model_arch='YOLO'):
+
+def split_by_lod(np_out, lod, batch_size):
+    """split a batched output into per-image outputs
+    Args:
+        np_out (np.ndarray): output of predictor, None if not fetched
+        lod (list): level of detail of the output, offsets of each image
+        batch_size (int): number of images in the batch
+    Returns:
+        outs (list): output of each image
+    """
+    if np_out is None:
+        return [None] * batch_size
+    if not lod or len(lod[0]) != batch_size + 1:
+        # no object detected in the whole batch
+        return [np_out[:0]] * batch_size
+    offsets = lod[0]
+    return [np_out[offsets[i]:offsets[i + 1]] for i in range(batch_size)]
+
+
+def get_input_shape(preprocess_infos):
+    """deduce the shape of image fed to model from preprocess config
+    Args:
+        preprocess_infos (list): preprocess ops defined in infer_cfg.yml
+    Returns:
+        im_shape (tuple): [C, H, W], None if it depends on the input image
+    """
+    im_shape = None
+    for op_info in preprocess_infos:
+        op_type = op_info['type']
+        if op_type == 'Resize':
+            # max_size keeps the aspect ratio of input image
+            if op_info.get('max_size', 0) != 0:
+                return None
+            target_size = op_info['target_size']
+            im_shape = [3, target_size, target_size]
+        elif op_type == 'Permute':
+            if not op_info.get('channel_first', True):
+                return None
+        elif op_type == 'PadStride' and im_shape is not None:
+            stride = op_info.get('stride', 0)
+            if stride > 0:
+                im_shape[1:] = [
+                    int(np.ceil(float(x) / stride) * stride)
+                    for x in im_shape[1:]
+                ]
+    return tuple(im_shape) if im_shape is not None else None
+
+
+def pin_memory(arr):
+    """page-lock the memory of array by cudaHostRegister, the memory is
+    unregistered by cudaHostUnregister when the array is released
+    Args:
+        arr (np.ndarray): C contiguous array
+    Returns:
+        pinned (bool): whether the memory is pinned
+    """
+    lib_path = ctypes.util.find_library('cudart')
+    if lib_path is None:
+        return False
+    try:
+        cudart = ctypes.CDLL(lib_path)
+    except OSError:
+        return False
+    # flags: cudaHostRegisterDefault, returns cudaSuccess == 0
+    ptr = ctypes.c_void_p(arr.ctypes.data)
+    ret = cudart.cudaHostRegister(ptr, ctypes.c_size_t(arr.nbytes), 0)
+    if ret != 0:
+        return False
+    # numpy must not free memory that is still page-locked, the callback
+    # runs before the array data is freed
+    weakref.finalize(arr, cudart.cudaHostUnregister, ptr)
+    return True
+
+
+def fill_input(info_bufs, name, values, dtype):
+    # write values into the reusable [1, N] array of name, or create one
+    if info_bufs is not None and name in info_bufs:
+        buf = info_bufs[name]
+        buf[0] = values
+        return buf
+    return np.array([values]).astype(dtype)
+
+
+def create_inputs(im, im_info, arch_tag=ARCH_YOLO, info_bufs=None):
     """generate input for different model type
     Args:
         im (np.ndarray): image (np.ndarray)
         im_info (dict): info of image
-        model_arch (str): model type
+        arch_tag (int): tag of model type, one of ARCH_*
+        info_bufs (dict): [1, N] arrays to write inputs besides image into,
+                          new arrays are created for missing ones, the
+                          returned inputs alias the given arrays
     Returns:
         inputs (dict): input of model
     """
@@ -302,26 +579,26 @@ def create_inputs(im, im_info, model_arch='YOLO'):
     pad_shape = list(im_info['pad_shape']) if im_info[
         'pad_shape'] is not None else list(im_info['resize_shape'])
     scale_x, scale_y = im_info['scale']
-    if 'YOLO' in model_arch:
-        im_size = np.array([origin_shape]).astype('int32')
-        inputs['im_size'] = im_size
-    elif 'RetinaNet' in model_arch or 'EfficientDet' in model_arch:
+    if arch_tag == ARCH_YOLO:
+        inputs['im_size'] = fill_input(info_bufs, 'im_size', origin_shape,
+                                       'int32')
+    elif arch_tag == ARCH_RETINA_OR_EFFDET:
         scale = scale_x
-        im_info = np.array([pad_shape + [scale]]).astype('float32')
-        inputs['im_info'] = im_info
-    elif ('RCNN' in model_arch) or ('FCOS' in model_arch):
+        inputs['im_info'] = fill_input(info_bufs, 'im_info',
+                                       pad_shape + [scale], 'float32')
+    elif arch_tag == ARCH_RCNN_OR_FCOS:
         scale = scale_x
-        im_info = np.array([pad_shape + [scale]]).astype('float32')
-        im_shape = np.array([origin_shape + [1.]]).astype('float32')
-        inputs['im_info'] = im_info
-        inputs['im_shape'] = im_shape
-    elif 'TTF' in model_arch:
+        inputs['im_info'] = fill_input(info_bufs, 'im_info',
+                                       pad_shape + [scale], 'float32')
+        inputs['im_shape'] = fill_input(info_bufs, 'im_shape',
+                                        origin_shape + [1.], 'float32')
+    elif arch_tag == ARCH_TTF:
         scale_factor = np.array([scale_x, scale_y] * 2).astype('float32')
         inputs['scale_factor'] = scale_factor
-    elif 'SOLOv2' in model_arch:
+    elif arch_tag == ARCH_SOLO:
         scale = scale_x
-        im_info = np.array([resize_shape + [scale]]).astype('float32')
-        inputs['im_info'] = im_info
+        inputs['im_info'] = fill_input(info_bufs, 'im_info',
+                                       resize_shape + [scale], 'float32')
     return inputs
 
 
@@ -336,9 +613,11 @@ class Config():
         deploy_file = os.path.join(model_dir, 'infer_cfg.yml')
         with open(deploy_file) as f:
             yml_conf = yaml.safe_load(f)
-        self.check_model(yml_conf)
+        self.model_type = self.check_model(yml_conf)
+        self.arch_tag = ARCH_TAGS.get(self.model_type, ARCH_OTHER)
         self.arch = yml_conf['arch']
         self.preprocess_infos = yml_conf['Preprocess']
+        self.preprocess_ops = self.create_preprocess_ops()
         self.use_python_inference = yml_conf['use_python_inference']
         self.min_subgraph_size = yml_conf['min_subgraph_size']
         self.labels = yml_conf['label_list']
@@ -352,15 +631,38 @@ class Config():
 
     def check_model(self, yml_conf):
         """
+        Returns:
+            model_type (str): supported model type the arch belongs to,
+                              e.g. 'RCNN' for CascadeRCNN
         Raises:
             ValueError: loaded model not in supported model type
         """
-        for support_model in SUPPORT_MODELS:
-            if support_model in yml_conf['arch']:
-                return True
+        arch = yml_conf['arch']
+        for support_model in MODEL_TYPE_ORDER:
+            if support_model in arch:
+                return support_model
         raise ValueError("Unsupported arch: {}, expect {}".format(yml_conf[
             'arch'], SUPPORT_MODELS))
 
+    def create_preprocess_ops(self):
+        """
+        Returns:
+            preprocess_ops (list): operators built once from preprocess_infos
+        Raises:
+            ValueError: preprocess op not in supported op type
+        """
+        preprocess_ops = []
+        for op_info in self.preprocess_infos:
+            new_op_info = op_info.copy()
+            op_type = new_op_info.pop('type')
+            if op_type not in PREPROCESS_OPS:
+                raise ValueError("Unsupported preprocess op: {}, expect {}"
+                                 .format(op_type, list(PREPROCESS_OPS)))
+            if op_type == 'Resize':
+                new_op_info['arch'] = self.arch
+            preprocess_ops.append(PREPROCESS_OPS[op_type](**new_op_info))
+        return fuse_preprocess_ops(preprocess_ops)
+
     def print_config(self):
         print('-----------  Model Configuration -----------')
         print('%s: %s' % ('Model Arch', self.arch))
@@ -383,15 +685,27 @@ def load_predictor(model_dir,
     Returns:
         predictor (PaddlePredictor): AnalysisPredictor
     Raises:
-        ValueError: predict by TensorRT need use_gpu == True.
+        ValueError: predict by TensorRT need use_gpu == True,
+                    predict by MKLDNN need use_gpu == False,
+                    mkldnn_bf16/mkldnn_int8 not supported by installed
+                    PaddlePaddle.
     """
-    if not use_gpu and not run_mode == 'fluid':
+    if not use_gpu and run_mode.startswith('trt'):
         raise ValueError(
             "Predict by TensorRT mode: {}, expect use_gpu==True, but use_gpu == {}"
             .format(run_mode, use_gpu))
-    if run_mode == 'trt_int8':
-        raise ValueError("TensorRT int8 mode is not supported now, "
-                         "please use trt_fp32 or trt_fp16 instead.")
+    if use_gpu and run_mode.startswith('mkldnn'):
+        raise ValueError(
+            "Predict by MKLDNN mode: {}, expect use_gpu==False, but use_gpu == {}"
+            .format(run_mode, use_gpu))
+    if run_mode == 'mkldnn_bf16' and not hasattr(fluid.core.AnalysisConfig,
+                                                 'enable_mkldnn_bfloat16'):
+        raise ValueError("MKLDNN bfloat16 mode needs PaddlePaddle >= 2.0, "
+                         "please upgrade or use fluid instead.")
+    if run_mode == 'mkldnn_int8' and not hasattr(fluid.core.AnalysisConfig,
+                                                 'enable_mkldnn_int8'):
+        raise ValueError("MKLDNN int8 mode needs PaddlePaddle >= 2.3, "
+                         "please upgrade or use fluid instead.")
     precision_map = {
         'trt_int8': fluid.core.AnalysisConfig.Precision.Int8,
         'trt_fp32': fluid.core.AnalysisConfig.Precision.Float32,
@@ -407,8 +721,18 @@ def load_predictor(model_dir,
         config.switch_ir_optim(True)
     else:
         # config.disable_gpu()
-        # 优化识别速度
-        config.set_cpu_math_library_num_threads(16)
+        # 优化识别速度, 线程数取物理核数避免超线程争抢
+        cpu_threads = max(1, (os.cpu_count() or 2) // 2)
+        config.set_cpu_math_library_num_threads(cpu_threads)
+        # use MKLDNN kernels, cache kernels of recent input shapes
+        config.enable_mkldnn()
+        config.set_mkldnn_cache_capacity(10)
+        if run_mode == 'mkldnn_bf16':
+            # need AVX512-BF16, e.g. Cooper Lake or later Xeon
+            config.enable_mkldnn_bfloat16()
+        elif run_mode == 'mkldnn_int8':
+            # need AVX512-VNNI, outputs are dequantized to float32
+            config.enable_mkldnn_int8({'conv2d', 'fc', 'pool2d'})
 
     if run_mode in precision_map.keys():
         config.enable_tensorrt_engine(
@@ -417,7 +741,8 @@ def load_predictor(model_dir,
             min_subgraph_size=min_subgraph_size,
             precision_mode=precision_map[run_mode],
             use_static=False,
-            use_calib_mode=False)
+            # int8 collects calibration table on the first runs, see calibrate
+            use_calib_mode=run_mode == 'trt_int8')
 
     # disable print log when predict
     config.disable_glog_info()
@@ -429,6 +754,18 @@ def load_predictor(model_dir,
     return predictor
 
 
+def calibrate(detector, image_dir='./imgs'):
+    """run images through the predictor to collect int8 calibration table
+    for run_mode 'trt_int8', the table is written to `_opt_cache` under
+    model_dir once the predictor is released and loaded by later runs
+    Args:
+        detector (object): Detector created with run_mode='trt_int8'
+        image_dir (str): directory of sample images, a few hundred is enough
+    """
+    for img in os.listdir(image_dir):
+        detector.predict(os.path.join(image_dir, img), run_benchmark=True)
+
+
 def load_executor(model_dir, use_gpu=False):
     if use_gpu:
         place = fluid.CUDAPlace(0)
@@ -448,10 +785,12 @@ def visualize(image_file,
               labels,
               mask_resolution=14,
               output_dir='output/',
-              threshold=0.5):
-    # visualize the predict result
+              threshold=0.5,
+              im=None):
+    # visualize the predict result, draw on im (decoded RGB image of
+    # image_file) when given instead of reading image_file again
     im = visualize_box_mask(
-        image_file,
+        image_file if im is None else im,
         results,
         labels,
         mask_resolution=mask_resolution,
@@ -470,9 +809,80 @@ def print_arguments(args):
         print('%s: %s' % (arg, value))
     print('------------------------------------------')
 
+def put_until_stopped(q, item, stop_event):
+    # put item without blocking forever once the pipeline is stopped
+    while True:
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            if stop_event.is_set():
+                return False
+
+
+def read_frames(capture, frame_queue, stop_event, errors):
+    # decode frames ahead of inference, None marks the end of video
+    try:
+        while not stop_event.is_set():
+            ret, frame = capture.read()
+            if not ret:
+                break
+            if not put_until_stopped(frame_queue, frame, stop_event):
+                return
+        put_until_stopped(frame_queue, None, stop_event)
+    except Exception as e:
+        # stop the whole pipeline, predict_video raises it after cleanup
+        errors.append(e)
+        stop_event.set()
+
+
+def write_frames(writer,
+                 result_queue,
+                 stop_event,
+                 errors,
+                 labels,
+                 mask_resolution=14,
+                 threshold=0.5,
+                 show_queue=None):
+    # draw and encode frames behind inference, None marks the end of video,
+    # drawn frames are handed to show_queue for display on the main thread
+    try:
+        while True:
+            try:
+                item = result_queue.get(timeout=0.1)
+            except queue.Empty:
+                if stop_event.is_set():
+                    break
+                continue
+            if item is None:
+                break
+            frame, results = item
+            # the frame is not used after predict, draw on it in place to
+            # skip the PIL image and the copy back to numpy
+            im = visualize_box_mask(
+                frame,
+                results,
+                labels,
+                mask_resolution=mask_resolution,
+                threshold=threshold,
+                draw_into=frame)
+            writer.write(im)
+            if show_queue is not None:
+                try:
+                    show_queue.put_nowait(im)
+                except queue.Full:
+                    pass
+    except Exception as e:
+        # stop the whole pipeline, predict_video raises it after cleanup
+        errors.append(e)
+        stop_event.set()
+
+
 def predict_video(detector, video_file, output_dir,camera_id, threshold=0.5):
     if camera_id != -1:
         capture = cv2.VideoCapture(camera_id)
+        # keep only the latest camera frame to reduce latency
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         video_name = 'output.mp4'
     else:
         capture = cv2.VideoCapture(video_file)
@@ -485,27 +895,56 @@ def predict_video(detector, video_file, output_dir,camera_id, threshold=0.5):
         os.makedirs(output_dir)
     out_path = os.path.join(output_dir, video_name)
     writer = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
+    # read and write frames in background threads to overlap with inference,
+    # bounded queues keep memory from growing when inference is slower
+    frame_queue = queue.Queue(maxsize=4)
+    result_queue = queue.Queue(maxsize=4)
+    # HighGUI must run on the main thread, drawer only hands frames over
+    show_queue = queue.Queue(maxsize=1) if camera_id != -1 else None
+    stop_event = threading.Event()
+    errors = []
+    reader = threading.Thread(
+        target=read_frames,
+        args=(capture, frame_queue, stop_event, errors))
+    drawer = threading.Thread(
+        target=write_frames,
+        args=(writer, result_queue, stop_event, errors,
+              detector.config.labels, detector.config.mask_resolution,
+              threshold, show_queue))
+    reader.start()
+    drawer.start()
     index = 1
-    while (1):
-        ret, frame = capture.read()
-        if not ret:
-            break
-        print('detect frame:%d' % (index))
-        index += 1
-        results = detector.predict(frame, threshold)
-        im = visualize_box_mask(
-            frame,
-            results,
-            detector.config.labels,
-            mask_resolution=detector.config.mask_resolution,
-            threshold=threshold)
-        im = np.array(im)
-        writer.write(im)
-        if camera_id != -1:
-            cv2.imshow('Mask Detection', im)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+    try:
+        while not stop_event.is_set():
+            try:
+                frame = frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if frame is None:
                 break
-    writer.release()
+            print('detect frame:%d' % (index))
+            index += 1
+            results = detector.predict(frame, threshold)
+            put_until_stopped(result_queue, (frame, results), stop_event)
+            if show_queue is not None:
+                try:
+                    cv2.imshow('Mask Detection', show_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    stop_event.set()
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        # None lets drawer finish the queued frames at the end of video
+        put_until_stopped(result_queue, None, stop_event)
+        reader.join()
+        drawer.join()
+        capture.release()
+        writer.release()
+    if errors:
+        raise errors[0]
 
 
 def predict_image(detector, image_file, run_benchmark=True, threshold=0.5):
@@ -528,16 +967,39 @@ def predict_image(detector, image_file, run_benchmark=True, threshold=0.5):
     return results
 
 
+def predict_image_batch(detector, image_files, images=None, threshold=0.5):
+    # images: decoded RGB images of image_files, read from disk if None
+    if images is None:
+        images = image_files
+    results_list = detector.predict_batch(images, threshold)
+    for image_file, image, results in zip(image_files, images, results_list):
+        visualize(
+            image_file,
+            results,
+            detector.config.labels,
+            mask_resolution=detector.config.mask_resolution,
+            output_dir='./output',
+            threshold=threshold,
+            im=image if isinstance(image, np.ndarray) else None)
+    return results_list
 
 
-def main():
+def main(batch_size=8):
     config = Config('./models')
-    detector = Detector(config, './models', use_gpu=False)
-    # predict from image
-    img_path_list = os.listdir('./imgs')
-    for img in img_path_list:
-        results = predict_image(detector, './imgs/{}'.format(img), run_benchmark=False)
-        print(results, '='*100)
+    detector = Detector(
+        config, './models', use_gpu=False, batch_size=batch_size)
+    # predict from image, batch_size images per run
+    img_path_list = [
+        './imgs/{}'.format(img) for img in os.listdir('./imgs')
+    ]
+    # decode all images up front, keep disk I/O and decoding out of the loop
+    images = [decode_image(img_path, {})[0] for img_path in img_path_list]
+    for i in range(0, len(img_path_list), batch_size):
+        results_list = predict_image_batch(
+            detector, img_path_list[i:i + batch_size],
+            images[i:i + batch_size])
+        for results in results_list:
+            print(results, '='*100)
 
 if __name__ == '__main__':
     print('加载模型开始预测>>')
@@ -109,10 +109,11 @@ class Resize(object):
             im = im.resize((int(resize_w), int(resize_h)), self.interp)
             im = np.array(im)
 
-        # padding im when image_shape fixed by infer_cfg.yml
+        # padding im when image_shape fixed by infer_cfg.yml, keep uint8
+        # until Normalize to move 4x less bytes
         if self.max_size != 0 and self.image_shape is not None:
             padding_im = np.zeros(
-                (self.max_size, self.max_size, im_channel), dtype=np.float32)
+                (self.max_size, self.max_size, im_channel), dtype=im.dtype)
             im_h, im_w = im.shape[:2]
             padding_im[:im_h, :im_w, :] = im
             im = padding_im
@@ -239,8 +240,103 @@ class PadStride(object):
         return padding_im, im_info
 
 
-def preprocess(im, preprocess_ops):
-    # process image by preprocess_ops
+class FusedNormalizePermute(object):
+    """normalize, permute and pad image in one pass, equal to
+    Normalize(is_channel_first=False) -> Permute(channel_first=True)
+    -> PadStride(stride)
+    Args:
+        mean (list): im - mean
+        std (list): im / std
+        is_scale (bool): whether need im / 255
+        to_bgr (bool): whether convert RGB to BGR
+        stride (int): model with FPN need image shape % stride == 0, 0: no pad
+    """
+
+    def __init__(self, mean, std, is_scale=True, to_bgr=False, stride=0):
+        mean = np.array(mean, dtype=np.float32)
+        std = np.array(std, dtype=np.float32)
+        # (im / 255 - mean) / std == im * scale - offset
+        self.scale = (1. / std) / (255. if is_scale else 1.)
+        self.offset = mean / std
+        self.to_bgr = to_bgr
+        if self.to_bgr:
+            self.scale = self.scale[::-1]
+            self.offset = self.offset[::-1]
+        self.scale = self.scale[:, np.newaxis, np.newaxis].copy()
+        self.offset = self.offset[:, np.newaxis, np.newaxis].copy()
+        self.coarsest_stride = stride
+        # output buffer, reused while the image shape keeps the same
+        self.out = None
+
+    def __call__(self, im, im_info):
+        """
+        Args:
+            im (np.ndarray): image (np.ndarray)
+            im_info (dict): info of image
+        Returns:
+            im (np.ndarray):  processed image (np.ndarray)
+            im_info (dict): info of processed image
+        """
+        im_h, im_w, im_c = im.shape
+        pad_h, pad_w = im_h, im_w
+        coarsest_stride = self.coarsest_stride
+        if coarsest_stride > 0:
+            pad_h = int(
+                np.ceil(float(im_h) / coarsest_stride) * coarsest_stride)
+            pad_w = int(
+                np.ceil(float(im_w) / coarsest_stride) * coarsest_stride)
+            im_info['pad_shape'] = (pad_h, pad_w)
+        if self.out is None or self.out.shape != (im_c, pad_h, pad_w):
+            self.out = np.zeros((im_c, pad_h, pad_w), dtype=np.float32)
+        else:
+            self.out[:, im_h:, :] = 0
+            self.out[:, :im_h, im_w:] = 0
+        src = im.transpose((2, 0, 1))
+        if self.to_bgr:
+            src = src[::-1]
+        dst = self.out[:, :im_h, :im_w]
+        np.multiply(src, self.scale, out=dst, casting='unsafe')
+        dst -= self.offset
+        return self.out, im_info
+
+
+def fuse_preprocess_ops(preprocess_ops):
+    """replace Normalize -> Permute (-> PadStride) by FusedNormalizePermute
+    Args:
+        preprocess_ops (list): preprocess operators
+    Returns:
+        fused_ops (list): preprocess operators with fused ones
+    """
+    fused_ops = []
+    i = 0
+    while i < len(preprocess_ops):
+        op = preprocess_ops[i]
+        next_op = preprocess_ops[i + 1] if i + 1 < len(
+            preprocess_ops) else None
+        if isinstance(op, Normalize) and not op.is_channel_first and \
+                isinstance(next_op, Permute) and next_op.channel_first:
+            i += 2
+            stride = 0
+            if i < len(preprocess_ops) and isinstance(preprocess_ops[i],
+                                                      PadStride):
+                stride = preprocess_ops[i].coarsest_stride
+                i += 1
+            fused_ops.append(
+                FusedNormalizePermute(
+                    op.mean,
+                    op.std,
+                    is_scale=op.is_scale,
+                    to_bgr=next_op.to_bgr,
+                    stride=stride))
+            continue
+        fused_ops.append(op)
+        i += 1
+    return fused_ops
+
+
+def preprocess(im, preprocess_ops, im_buf=None):
+    # process image by preprocess_ops, write the result into im_buf
+    # ([1, C, H, W] float32) instead of a new array when the shape matches
     im_info = {
         'scale': [1., 1.],
         'origin_shape': None,
@@ -250,5 +346,8 @@ def preprocess(im, preprocess_ops):
     im, im_info = decode_image(im, im_info)
     for operator in preprocess_ops:
         im, im_info = operator(im, im_info)
+    if im_buf is not None and im_buf.shape[1:] == im.shape:
+        np.copyto(im_buf[0], im)
+        return im_buf, im_info
     im = np.array((im, )).astype('float32')
     return im, im_info
@@ -21,7 +21,12 @@ from PIL import Image, ImageDraw
 from scipy import ndimage
 
 
-def visualize_box_mask(im, results, labels, mask_resolution=14, threshold=0.5):
+def visualize_box_mask(im,
+                       results,
+                       labels,
+                       mask_resolution=14,
+                       threshold=0.5,
+                       draw_into=None):
     """
     Args:
         im (str/np.ndarray): path of image/np.ndarray read by cv2
@@ -32,9 +37,27 @@ def visualize_box_mask(im, results, labels, mask_resolution=14, threshold=0.5):
         labels (list): labels:['class1', ..., 'classn']
         mask_resolution (int): shape of a mask is:[mask_resolution, mask_resolution]
         threshold (float): Threshold of score.
+        draw_into (np.ndarray): uint8 buffer of im's shape, may be im itself,
+                                draw on it in place instead of a PIL image
     Returns:
-        im (PIL.Image.Image): visualized image
+        im (PIL.Image.Image/np.ndarray): visualized image, draw_into if given
     """
+    if draw_into is not None:
+        if isinstance(im, str):
+            im = np.array(Image.open(im).convert('RGB'))
+        if draw_into is not im:
+            np.copyto(draw_into, im)
+        if list(results.keys()) == ['boxes']:
+            return draw_box_cv2(draw_into, results['boxes'], labels)
+        # masks, segm and landmark are only drawn by PIL
+        im = visualize_box_mask(
+            draw_into,
+            results,
+            labels,
+            mask_resolution=mask_resolution,
+            threshold=threshold)
+        np.copyto(draw_into, np.asarray(im))
+        return draw_into
     if isinstance(im, str):
         im = Image.open(im).convert('RGB')
     else:
@@ -200,6 +223,45 @@ def draw_box(im, np_boxes, labels):
     return im
 
 
+def draw_box_cv2(im, np_boxes, labels):
+    """
+    Args:
+        im (np.ndarray): image of uint8, drawn in place
+        np_boxes (np.ndarray): shape:[N,6], N: number of box,
+                               matix element:[class, score, x_min, y_min, x_max, y_max]
+        labels (list): labels:['class1', ..., 'classn']
+    Returns:
+        im (np.ndarray): visualized image
+    """
+    draw_thickness = max(min(im.shape[:2]) // 320, 1)
+    clsid2color = {}
+    color_list = get_color_map_list(len(labels))
+
+    for dt in np_boxes:
+        clsid, bbox, score = int(dt[0]), dt[2:], dt[1]
+        xmin, ymin, xmax, ymax = [int(round(x)) for x in bbox]
+        if clsid not in clsid2color:
+            clsid2color[clsid] = color_list[clsid]
+        color = tuple(clsid2color[clsid])
+
+        # draw bbox
+        cv2.rectangle(im, (xmin, ymin), (xmax, ymax), color, draw_thickness)
+
+        # draw label
+        text = "{} {:.4f}".format(labels[clsid], score)
+        (tw, th), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+        cv2.rectangle(im, (xmin + 1, ymin - th - 2), (xmin + tw + 1, ymin),
+                      color, -1)
+        cv2.putText(
+            im,
+            text, (xmin + 1, ymin - 2),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.4, (255, 255, 255),
+            1,
+            lineType=cv2.LINE_AA)
+    return im
+
+
 def draw_segm(im,
               np_segms,
               np_label,